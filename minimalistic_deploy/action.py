@@ -1,6 +1,14 @@
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field, fields
 from typing import List, Dict
-import json
+from .utils import dump_json, DeployConfigError
+
+
+# Attributes (and extra params) which must be provided for each action type
+_REQUIRED_BY_TYPE = {
+    'stat_file': {'params': ('register', ), 'extra': ('path', )},
+    'stat_dir': {'params': ('register', ), 'extra': ('path', )},
+    'copy': {'params': (), 'extra': ('destination', )},
+}
 
 
 @dataclass
@@ -34,8 +42,32 @@ class Action:
     #     }
     #     return cls(**kwargs, extra=extra)
 
+    def validate(self):
+        """
+        Check that all params required by the action type have been provided;
+        called once after loading, so that execution doesn't need to check again
+        """
+        required = _REQUIRED_BY_TYPE.get(self.type)
+        if required is None:
+            return
+        for p in required['params']:
+            if not getattr(self, p):
+                raise DeployConfigError('Action "%s": missing attribute "%s"' % (self, p))
+        for p in required['extra']:
+            if p not in self.extra:
+                raise DeployConfigError('Action "%s": missing attribute extra["%s"]' % (self, p))
+
     def __str__(self):
         return str(self.title)
 
     def __repr__(self):
-        return "Action<%s>" % json.dumps(asdict(self), indent=4)
+        return "Action<%s>" % self.title
+
+    def describe(self):
+        """
+        Full dump of the action, for debugging
+        """
+        # Actions are never modified after loading, so we can build the dump only once
+        if not hasattr(self, '_description'):
+            self._description = dump_json({f.name: getattr(self, f.name) for f in fields(self)})
+        return self._description
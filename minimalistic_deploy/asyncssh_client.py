@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import asyncio
+import atexit
+import functools
+import logging
+import subprocess
+import threading
+
+try:
+    import asyncssh
+except ModuleNotFoundError:
+    asyncssh = None
+
+from .ssh_client import SSHClient
+from .utils import print_message
+
+
+@functools.lru_cache(maxsize=None)
+def event_loop():
+    """
+    Event loop (shared by all clients of this process) running in a background thread;
+    hosts are still driven by their own threads, which just wait for the results
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='asyncssh', daemon=True).start()
+    return loop
+
+
+class AsyncSSHClient(SSHClient):
+    """
+    Same as SSHClient, but remote commands are executed via asyncssh
+    on a single connection per host, which is opened on first use and kept
+    for the whole run; this saves both the ssh process and the handshake for each command.
+
+    Connection parameters are read from the user's ~/.ssh/config and known hosts;
+    ssh_options are not supported.
+    rsync still runs as a separate process (multiplexed when requested).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._connection = None
+
+    @staticmethod
+    def is_available():
+        return asyncssh is not None
+
+    def exec_command(self, command, become=False, become_user='', wrap_bash=True, capture_output=True):
+        """
+        capture_output: collect and return the command output;
+        when False, the output is only logged, and an empty string is returned
+        """
+        inner_command = self.render_string(
+            self._build_inner_command(command, become, become_user, wrap_bash)
+        )
+        self._log(logging.DEBUG, '%s: %s' % (self._remote_address(), inner_command))
+        if self.dry_run:
+            return ''
+
+        future = asyncio.run_coroutine_threadsafe(self._run(inner_command, capture_output), event_loop())
+        try:
+            return future.result()
+        except subprocess.CalledProcessError as e:
+            if self.verbose:
+                print_message('%s | ERROR ....................: exit status %d' % (self.name, e.returncode), False)
+            raise
+
+    def close_connection(self):
+        """
+        Close the connection, if any
+        """
+        if self._connection is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close(), event_loop())
+        future.result(timeout=10)
+
+    async def _connect(self):
+        if self._connection is None:
+            # Omitted options are resolved by asyncssh as ssh would (config file, current user)
+            options = {}
+            if self.ssh_user:
+                options['username'] = self.ssh_user
+            if self.timeout:
+                options['connect_timeout'] = self.timeout
+            self._connection = await asyncssh.connect(self.host, **options)
+            atexit.register(self.close_connection)
+        return self._connection
+
+    async def _close(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            connection.close()
+            await connection.wait_closed()
+
+    async def _run(self, command, capture_output):
+        connection = await self._connect()
+        lines = []
+        async with connection.create_process(command, stderr=asyncssh.STDOUT) as process:
+            # Output is logged line by line as soon as it is produced
+            async for line in process.stdout:
+                if not line:
+                    # End of stream
+                    break
+                self._log(logging.DEBUG, line.rstrip('\n'))
+                if capture_output:
+                    lines.append(line)
+            completed = await process.wait()
+        result = ''.join(lines)
+        if completed.returncode:
+            raise subprocess.CalledProcessError(completed.returncode, command, output=result)
+        return result
@@ -1,14 +1,20 @@
+import functools
 import logging
-import subprocess
 import os
-from dataclasses import dataclass, field, asdict
+import re
+import shlex
+from dataclasses import dataclass, field, fields, replace
 from typing import List, Dict
 from collections import UserDict
-import jinja2
-import json
 from .ssh_client import SSHClient
+from .asyncssh_client import AsyncSSHClient
 from .action import Action
-from .utils import merge_dicts
+from .utils import merge_dicts, has_template_markers, recursive_render, dump_json, print_message, DeployConfigError
+
+try:
+    from rich.text import Text
+except ModuleNotFoundError:
+    Text = None
 
 logger = logging.getLogger("deploy")
 
@@ -19,14 +25,42 @@ class Context(UserDict):
         return self.__repr__()
 
     def __repr__(self):
-        return "Context<%s>" % json.dumps(self.data, indent=4)
+        return "Context<%s>" % dump_json(self.data)
+
+
+# Printed by remote commands to report a missing path
+MISSING_SENTINEL = '__MISSING__'
+
+# Special forms recognized by Host.evaluate_expression(), and their handlers;
+# each handler receives the host, the whole expression text, the text
+# enclosed in the outer parenthesis, and the current action
+_EXPRESSION_RE = re.compile(r'^(results\[|eval\(|not_exists_dir\(|exists_dir\(|not_exists_file\(|exists_file\()')
+_RESULTS_RE = re.compile(r"""results\[['"](\w+)['"]\]""")
+
+
+def _evaluate_results(host, text, inner, action):
+    # Plain "results['key']" lookups need no eval() at all
+    m = _RESULTS_RE.fullmatch(text)
+    if m:
+        return host.results[m.group(1)]
+    return host.eval_python("self." + text)
+
 
+_EXPRESSION_HANDLERS = {
+    'results[': _evaluate_results,
+    'eval(': lambda host, text, inner, action: host.eval_python(inner),
+    'not_exists_dir(': lambda host, text, inner, action: not host.check_remote_path_exists(host.eval_python(inner), True, action),
+    'exists_dir(': lambda host, text, inner, action: host.check_remote_path_exists(host.eval_python(inner), True, action),
+    'not_exists_file(': lambda host, text, inner, action: not host.check_remote_path_exists(host.eval_python(inner), False, action),
+    'exists_file(': lambda host, text, inner, action: host.check_remote_path_exists(host.eval_python(inner), False, action),
+}
 
-class UserDictJsonEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, UserDict):
-            return obj.data
-        return json.JSONEncoder.default(self, obj)
+
+@functools.lru_cache(maxsize=512)
+def _compile_expression(source):
+    # The same "when" expressions are evaluated for every host;
+    # parse and compile each of them only once
+    return compile(source, '<when>', 'eval')
 
 
 @dataclass
@@ -36,14 +70,47 @@ class Host():
     files_foldername: str
     context: Context
     ssh_user: str = ''
+    ssh_backend: str = 'ssh'
     errors: int = 0
     results: Dict = field(default_factory = lambda: ({}))
 
+    def __post_init__(self):
+        # The SSHClient is shared by all actions; per-action attributes
+        # are updated by get_ssh_client()
+        if self.ssh_backend == 'ssh':
+            client_class = SSHClient
+        elif self.ssh_backend == 'asyncssh':
+            if AsyncSSHClient.is_available():
+                client_class = AsyncSSHClient
+            else:
+                logger.warning('Host "%s": asyncssh is not installed; falling back to the "ssh" backend' % self.name)
+                client_class = SSHClient
+        else:
+            raise DeployConfigError('Host "%s": unknown ssh_backend "%s"' % (self.name, self.ssh_backend))
+        self._ssh_client = client_class(
+            host=self.address,
+            ssh_user=self.ssh_user,
+            ssh_options='',
+            rsync_options='',
+            logger=logger,
+            render_context=self.context.data,
+            # Share a single connection among all commands
+            multiplex=True,
+            name=self.name,
+        )
+
     def __str__(self):
         return self.name
 
     def __repr__(self):
-        return "Host<%s>" % json.dumps(asdict(self), indent=4, cls=UserDictJsonEncoder)
+        return "Host<%s>" % self.name
+
+    def describe(self):
+        """
+        Full dump of the host, for debugging
+        """
+        # Avoid asdict(), which deep-copies the (potentially large) context and results
+        return dump_json({f.name: getattr(self, f.name) for f in fields(self)})
 
     def run_action(self, action, dry_run, extra_debug, colorize):
 
@@ -55,8 +122,8 @@ class Host():
         logger.info('--> "%s": %s ...' % (self, action))
         logger.debug("-" * 80)
         if self.extra_debug:
-            logger.debug(repr(self))
-            logger.debug(repr(action))
+            logger.debug(self.describe())
+            logger.debug(action.describe())
 
         # If when expression has been provided, evaluate it
         skip = False
@@ -80,7 +147,8 @@ class Host():
                         self.run_ssh(
                             action,
                             command,
-                            silent=False
+                            silent=False,
+                            capture_output=bool(action.register),
                         )
 
             elif action.type == "mkdirs":
@@ -120,31 +188,12 @@ class Host():
 
 
     def render_string(self, string):
-
-        # Jinja nested rendering on variable content
-        # https://stackoverflow.com/questions/8862731/jinja-nested-rendering-on-variable-content#34002296
-        def recursive_render(tpl, values):
-             prev = tpl
-             while True:
-                 curr = jinja2.Template(prev, undefined=jinja2.StrictUndefined).render(**values)
-                 if curr != prev:
-                     prev = curr
-                 else:
-                     return curr
-
-        # environment = jinja2.Environment()
-        # template = environment.from_string(string)
-        #return template.render(**asdict(self.context))
-        #return template.render(**(self.context))
+        if not has_template_markers(string):
+            return string
         return recursive_render(string, self.context.data)
 
     def print_message(self, line):
-        if self.colorize:
-            from rich.console import Console
-            console = Console()
-            console.print(line, style="yellow")
-        else:
-            print(line)
+        print_message(line, self.colorize)
 
     def evaluate_expression(self, expression, action=None):
         """
@@ -174,32 +223,26 @@ class Host():
         """
         text = self.render_string(expression)
 
-        brace_opener = text.find('(') + 1
-        brace_closer = text.find(')')
-        inner_text = text[brace_opener:brace_closer]
-
-        if text.startswith('results['):
-            result = eval("self." + text)
-        elif text.startswith("eval("):
-            result = eval(inner_text)
-        elif text.startswith('not_exists_dir('):
-            result = not self.check_remote_path_exists(eval(inner_text), True, action)
-        elif text.startswith('exists_dir('):
-            result = self.check_remote_path_exists(eval(inner_text), True, action)
-        elif text.startswith('not_exists_file('):
-            result = not self.check_remote_path_exists(eval(inner_text), False, action)
-        elif text.startswith('exists_file('):
-            result = self.check_remote_path_exists(eval(inner_text), False, action)
+        m = _EXPRESSION_RE.match(text)
+        if m:
+            inner_text = text[m.end():text.rfind(')')]
+            result = _EXPRESSION_HANDLERS[m.group(1)](self, text, inner_text, action)
         else:
             result = text
 
         return result
 
+    def eval_python(self, source):
+        """
+        Evaluate a Python expression, where "self" refers to this host
+        (and is the only name available, besides builtins)
+        """
+        return eval(_compile_expression(source), {'self': self})
+
     def log_message(self, lines):
         for line in lines:
             text = str(self.evaluate_expression(line)).strip()
             if self.colorize:
-                from rich.text import Text
                 message = Text('[yellow]' + text + '[/yellow]')
                 logger.info(message, extra={"markup": True})
             else:
@@ -207,35 +250,22 @@ class Host():
 
     def execute_mkdirs(self, action):
 
-        command = "mkdir -p "
+        parts = ['mkdir', '-p']
         if "mode" in action.extra:
-            command += "-m %s " % action.extra["mode"]
-        command += self.render_string(' '.join(action.items))
-        self.run_ssh(action, command, silent=False)
-
-    def check_required_action_params(self, action, params):
-        for p in params:
-            if not getattr(action, p):
-                raise Exception('Missing attribute "%s"' % p)
-
-    def check_required_action_extra_params(self, action, params):
-        for p in params:
-            if not p in action.extra:
-                raise Exception('Missing attribute extra["%s"]' % p)
+            parts += ['-m', str(action.extra["mode"])]
+        parts.append(self.render_string(' '.join(action.items)))
+        command = ' '.join(parts)
+        self.run_ssh(action, command, silent=False, capture_output=bool(action.register))
 
     def check_remote_path_exists(self, path, dir, action):
         if self.dry_run:
             return False
-        command  = 'test -%s "%s"' % (('d' if dir else 'e'), path, )
-        result = False
-        try:
-            # check existence
-            fake_action = Action(become=action.become, become_user=action.become_user, wrap_bash=True)
-            self.run_ssh(fake_action, command, silent=True)
-            result = True
-        except subprocess.CalledProcessError as e:
-            # Does not exists
-            result = False
+        # Report a missing path via a sentinel instead of an exit code,
+        # so that ssh errors are not mistaken for a missing path
+        command = 'test -%s "%s" || echo %s' % (('d' if dir else 'e'), path, MISSING_SENTINEL)
+        fake_action = Action(become=action.become, become_user=action.become_user, wrap_bash=True)
+        response = self.run_ssh(fake_action, command, silent=True)
+        result = MISSING_SENTINEL not in response
 
         logger.info('%s "%s" was %sfound' % (
             "dir" if dir else "file",
@@ -275,20 +305,24 @@ class Host():
                 "when": "eval(not self.results['result1']['exists'])"
             },
         """
-        self.check_required_action_params(action, ["register", ])
-        self.check_required_action_extra_params(action, ["path", ])
-        action.wrap_bash = False
-
-        command  = 'test -%s "%s"' % (('d' if dir else 'e'), action.extra["path"], )
-        result = {'exists': True}
-        try:
-            # check existence
-            self.run_ssh(action, command, silent=True)
-
-            format = '|'.join([c+':%'+c for c in 'aAFgGinNsuUXYZ'])
-            command = 'stat --format="%s" "%s"' % (format, action.extra["path"])
-            response = self.run_ssh(action, command, silent=False)
-            parsed_response = {t.split(':')[0]: t.split(':')[1].strip() for t in response.split('|')}
+        # Actions are shared among hosts: don't modify the given one
+        action = replace(action, wrap_bash=False)
+
+        # A single remote command both checks for existence and collects stats;
+        # a missing path is reported via a sentinel, while ssh (and sudo) errors still raise:
+        # for this, the check runs in a shell started by sudo, passing path and format as arguments.
+        # Symlinks are followed (-L), as "test -d" and "test -e" would do
+        format = '|'.join([c+':%'+c for c in 'aAFgGinNsuUXYZ'])
+        script = 'test -e "$1" || { echo %s; exit 0; }; exec stat -L --format="$2" "$1"' % MISSING_SENTINEL
+        command = 'bash -c %s _ "%s" "%s"' % (shlex.quote(script), action.extra["path"], format)
+        response = self.run_ssh(action, command, silent=False)
+
+        result = {'exists': False}
+        if response and MISSING_SENTINEL not in response:
+            parsed_response = {}
+            for t in response.split('|'):
+                k, _, v = t.partition(':')
+                parsed_response[k] = v.strip()
             # Example:
             #{
             #  'a': '755',                      access rights in octal (note '#' and '0' printf flags)
@@ -307,17 +341,36 @@ class Host():
             #  'Z': '1688596626',               time of last status change, seconds since Epoch
             #}
 
-            result = merge_dicts(result, parsed_response)
-
-        except subprocess.CalledProcessError as e:
-            # Does not exists
-            result = {'exists': False}
+            # "stat_dir" requires the path to be a directory (as "test -d" would)
+            if not dir or parsed_response.get('F') == 'directory':
+                result = merge_dicts({'exists': True}, parsed_response)
 
         self.results[action.register] = result
 
     def execute_copy(self, action):
+        """
+        Sample usage:
 
-        self.check_required_action_extra_params(action, ["destination", ])
+            {
+                "title": "Copy settings",
+                "type": "copy",
+                "become": true,
+                "become_user": "{{username}}",
+                "items": [
+                    "settings.py"
+                ],
+                "extra": {
+                    "destination": "{{project.website_home}}/",
+                    "template": true,       render files with Jinja before copying them
+                    "force": false,         overwrite existing files
+                    "mode": "644",
+                    "owner": "",
+                    "group": "",
+                    "delta": false,         use rsync's delta-transfer algorithm (default: send whole files)
+                    "compress": true        compress data during the transfer
+                }
+            },
+        """
 
         destination = action.extra['destination']
         for item in action.items:
@@ -328,19 +381,16 @@ class Host():
 
             self.run_rsync(action, source, destination, silent=False)
 
+    def get_ssh_client(self, action, silent):
+        client = self._ssh_client
+        client.verbose = not silent
+        client.dry_run = self.dry_run
+        client.timeout = action.timeout
+        client.colorize = self.colorize
+        return client
+
     def run_rsync(self, action, source, destination, silent):
-        client = SSHClient(
-            host=self.address,
-            ssh_user=self.ssh_user,
-            ssh_options='',
-            rsync_options='',
-            verbose=not silent,
-            dry_run=self.dry_run,
-            timeout=action.timeout,
-            colorize=self.colorize,
-            logger=logger,
-            render_context=self.context.data,
-        )
+        client = self.get_ssh_client(action, silent)
 
         result = client.exec_rsync(
             source=source,
@@ -351,38 +401,32 @@ class Host():
             mode=action.extra.get('mode', ''),
             owner=action.extra.get('owner', ''),
             group=action.extra.get('group', ''),
-            as_template=action.extra.get('template', False)
+            as_template=action.extra.get('template', False),
+            capture_output=bool(action.register),
+            whole_file=not action.extra.get('delta', False),
+            compress=action.extra.get('compress', True),
         )
 
         if action.register:
             self.results[action.register] = result
         return result
 
-    def run_ssh(self, action, command, silent):
+    def run_ssh(self, action, command, silent, capture_output=True):
         """
-        Prepare command for remote execution and run_ssh it
+        Prepare command for remote execution and run_ssh it;
+        the output is collected and returned only if capture_output is True
         Example:
             ssh -o ConnectTimeout=5 master@192.168.98.18 "sudo -H --non-interactive ls /home"
         """
 
-        client = SSHClient(
-            host=self.address,
-            ssh_user=self.ssh_user,
-            ssh_options='',
-            rsync_options='',
-            verbose=not silent,
-            dry_run=self.dry_run,
-            timeout=action.timeout,
-            colorize=self.colorize,
-            logger=logger,
-            render_context=self.context.data,
-        )
+        client = self.get_ssh_client(action, silent)
 
         result = client.exec_command(
             command,
             become=action.become,
             become_user=action.become_user,
             wrap_bash=action.wrap_bash,
+            capture_output=capture_output,
         )
 
         if action.register:
@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
 import copy
 import json
 import logging
 import os
+import sys
 import traceback
+import jinja2
 
 from .host import Host, Context
+from .asyncssh_client import AsyncSSHClient
 from .action import Action
-from .utils import merge_dicts, load_json_file
+from .utils import merge_dicts, load_json_file, DeployConfigError, has_template_markers, persist_template, enable_bytecode_cache, share_print_lock
 
 try:
     import rich
@@ -23,81 +27,134 @@ def load_vars(filename):
     return load_json_file(filename)
 
 
-def load_hosts(filename, hosts, vars, files_foldername):
+def load_hosts(filename, hosts, vars, files_foldername, ssh_backend='ssh'):
     # with open("hosts.json", "rt") as f:
     #     data = {k: v for k, v in json.load(f).items() if not v.get("disabled", False)}
-    data = load_json_file(filename, fail_silently=True if hosts is None else False)
-    data = {k: v for k, v in data.items() if not v.get("disabled", False)}
+    data = load_json_file(
+        filename,
+        fail_silently=True if hosts is None else False,
+        keep=lambda v: not v.get("disabled", False),
+    )
 
     if hosts is None:
         # Return only keys
         return data.keys()
 
-    if "*" in hosts:
+    hosts_set = set(hosts)
+    if "*" in hosts_set:
         selected_hosts = data
     else:
-        for h in hosts:
-            if h not in data.keys():
-                print('Available hosts: ' + ','.join(data.keys()))
-                raise Exception('Unknown host "%s"' % h)
-        selected_hosts = {k: v for k, v in data.items() if k in hosts}
+        missing = hosts_set - data.keys()
+        if missing:
+            print('Available hosts: ' + ','.join(data.keys()))
+            raise Exception('Unknown host "%s"' % next(h for h in hosts if h in missing))
+        selected_hosts = {k: v for k, v in data.items() if k in hosts_set}
 
     hosts = []
     for k, v in selected_hosts.items():
 
+        # Work on a copy, since parsed data is cached by load_json_file()
+        v = dict(v)
+
         # Remove unexpected parameters
         v.pop('disabled', None)
 
-        # Prepare Context merging "hosts vars" and global "default" vars
+        # Prepare Context merging "hosts vars" and global "default" vars;
+        # a plain dict is built once per host, since Jinja copies the context
+        # into a new dict at every render, and flattening a ChainMap would be much slower
         host_vars = v.pop('vars', {})
         context = merge_dicts(vars, host_vars)
 
-        params = merge_dicts({'name': k, 'files_foldername': files_foldername, 'context': Context(**context)}, v)
+        params = merge_dicts({
+            'name': k,
+            'files_foldername': files_foldername,
+            'context': Context(context),
+            'ssh_backend': ssh_backend,
+        }, v)
 
         hosts.append(Host(**params))
 
     return hosts
 
 
+def _precompile(action):
+    """
+    Compile in advance the templates which are rendered verbatim for each host
+    ("when" expressions and message items), so that rendering only has to hit the cache;
+    other fields are embedded into larger commands before rendering, so there's no point
+    """
+    sources = [action.when]
+    if action.type == 'message':
+        sources += action.items
+    for source in sources:
+        if has_template_markers(source):
+            try:
+                persist_template(source)
+            except jinja2.TemplateSyntaxError as e:
+                raise DeployConfigError('Action "%s": invalid template "%s": %s' % (action, source, str(e))) from e
+
+
 def load_actions(filename, tags):
-    def intersection(lst1, lst2):
-        lst3 = [value for value in lst1 if value in lst2]
-        return lst3
+
+    tags_set = frozenset(tags) if tags else None
+
+    def keep(a):
+        # Discard disabled actions, and those not matching any of the given tags
+        if a.get("disabled", False):
+            return False
+        return tags_set is None or not tags_set.isdisjoint(a.get("tags", ()))
 
     # with open(filename + ".json", "rt") as f:
     #     data = [a for a in json.load(f) if not a.get("disabled", False)]
     if not filename.lower().endswith('.json'):
         filename += ".json"
-    data = load_json_file(filename)
-    data = [a for a in data if not a.get("disabled", False)]
-
-    if not tags:
-        selected_actions = data
-    else:
-        selected_actions = [d for d in data if intersection(tags, d.get("tags", []))]
+    selected_actions = load_json_file(filename, keep=keep)
 
     actions = []
     for a in selected_actions:
         #actions.append(Action.from_dict(a))
+        # Work on a copy, since parsed data is cached by load_json_file()
+        a = dict(a)
         a.pop('tags', None)
 
-        actions.append(Action(**a))
+        action = Action(**a)
+        action.validate()
+        _precompile(action)
+        actions.append(action)
 
     return actions
 
 
 def work(args):
     vars = load_vars(args.vars_filename)
-    hosts = load_hosts(args.hosts_filename, args.hosts, vars, args.files_foldername)
+    ssh_backend = args.backend
+    if ssh_backend == 'asyncssh' and not AsyncSSHClient.is_available():
+        logger.warning('asyncssh is not installed; falling back to the "ssh" backend')
+        ssh_backend = 'ssh'
+    hosts = load_hosts(args.hosts_filename, args.hosts, vars, args.files_foldername, ssh_backend)
     actions = load_actions(args.actions_filename, args.tags)
-    for action in actions:
-        for host in hosts:
-            if host.errors <= 0:
+    if not hosts:
+        return
+
+    # With --parallel, each action is executed on up to N hosts concurrently
+    # (remote commands are mostly waiting for the network); we still wait for all hosts
+    # to complete an action before starting the next one, since later actions may depend
+    # on results registered by previous ones. Hosts are processed serially by default,
+    # as they might share the same server (and compete for its package manager, for example)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(args.parallel, len(hosts)))) as executor:
+        for action in actions:
+            futures = {
+                executor.submit(host.run_action, action, args.dry_run, args.extra_debug, rich and not args.no_colors, ): host
+                for host in hosts if host.errors <= 0
+            }
+            # Report failures as soon as they happen
+            for future in concurrent.futures.as_completed(futures):
+                host = futures[future]
                 try:
-                    host.run_action(action, args.dry_run, args.extra_debug, rich and not args.no_colors, )
+                    future.result()
                 except Exception as e:
                     host.errors += 1
-                    logger.error(e)
+                    logger.error('"%s": %s' % (host, e))
                     if args.traceback:
                         logger.error(traceback.format_exc())
 
@@ -108,9 +165,30 @@ def verbosity_to_log_level(verbosity):
     return log_level
 
 
+def hosts_help():
+    """
+    Help text for the "hosts" argument; listing the available hosts requires
+    parsing the hosts file, so we do it only when help has been requested
+    """
+    text = 'One or more deploy target'
+    argv = sys.argv[1:]
+    if '-h' not in argv and '--help' not in argv:
+        return text
+
+    # Honour --hosts-filename, if given
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--hosts-filename", default="hosts.json")
+    filename = parser.parse_known_args(argv)[0].hosts_filename
+    if not filename.lower().endswith('.json'):
+        filename += ".json"
+    if os.path.isfile(filename):
+        text += ' (available: %s)' % ', '.join(load_hosts(filename, None, None, None))
+    return text
+
+
 def main():
     parser = argparse.ArgumentParser(description="Simple deploy procedure. Required packages: Jinja2. Suggested packages: rich.")
-    parser.add_argument("hosts", nargs="+", help='One or more deploy target')
+    parser.add_argument("hosts", nargs="+", help=hosts_help())
     parser.add_argument("--tags", nargs="*", help="Optional tags for actions filtering")
     parser.add_argument("--actions-filename", "-a", default="deployment")
     parser.add_argument('-v', '--verbosity', type=int, choices=range(3), default=1, action='store', help="log verbosity level. Choose 0, 1 or 2. Default=1")
@@ -123,6 +201,14 @@ def main():
     parser.add_argument("--hosts-filename", default="hosts.json", help='hosts filename; default: "hosts.json"')
     parser.add_argument("--vars-filename", default="vars.json", help='vars filename; default: "vars.json"')
     parser.add_argument("--files-foldername", default="files", help='files foldername; default: "files"')
+    parser.add_argument("--parallel", "-j", type=int, default=1, metavar="N",
+        help="run each action on up to N hosts concurrently; default: 1 (one host at a time)")
+    parser.add_argument("--bytecode-cache", action="store_true",
+        help='persist compiled templates in "$XDG_CACHE_HOME/minimalistic-deploy/jinja" '
+        '(or "~/.cache/minimalistic-deploy/jinja", if XDG_CACHE_HOME is not set), to speed up later runs')
+    parser.add_argument("--backend", choices=["ssh", "asyncssh"], default="ssh",
+        help='how remote commands are executed: "ssh" runs the ssh client for each command, '
+        '"asyncssh" keeps a connection per host in process (requires asyncssh); default: "ssh"')
     args = parser.parse_args()
 
     if args.extra_debug and args.verbosity < 2:
@@ -144,8 +230,22 @@ def main():
             datefmt="[%X]",
         )
 
+    # asyncssh logs every connection and channel event at INFO level
+    if args.verbosity < 2:
+        logging.getLogger('asyncssh').setLevel(logging.WARNING)
+
+    # Log records and printed output from concurrent hosts are serialized by the same lock
+    for handler in logging.getLogger().handlers:
+        share_print_lock(handler)
+
+    if args.bytecode_cache:
+        enable_bytecode_cache()
+
     try:
         work(args)
+    except DeployConfigError as e:
+        logger.error(e)
+        sys.exit(1)
     except Exception as e:
         logger.error(e)
         if args.traceback:
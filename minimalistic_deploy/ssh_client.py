@@ -1,18 +1,58 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
+import functools
 import logging
+import shlex
 import subprocess
 import traceback
-import jinja2
 import tempfile
 import os
+import shutil
+
+try:
+    from .utils import has_template_markers, recursive_render, print_message
+except ImportError:
+    # Running as a standalone script
+    from utils import has_template_markers, recursive_render, print_message
+
+
+@functools.lru_cache(maxsize=None)
+def control_sockets_folder():
+    """
+    Private folder (shared by all clients of this process) for ssh control sockets;
+    removed on exit.
+    We use /tmp rather than $TMPDIR, which may be too long (e.g. on macOS) for the
+    ~104 bytes allowed for a unix socket path; mkdtemp() makes it private anyway
+    """
+    folder = tempfile.mkdtemp(prefix='mdeploy-', dir='/tmp')
+    atexit.register(shutil.rmtree, folder, ignore_errors=True)
+    return folder
+
+
+@functools.lru_cache(maxsize=None)
+def find_executable(name):
+    """
+    Resolve the full path of an executable once; besides avoiding a PATH lookup
+    at every invocation, this lets subprocess use the faster posix_spawn()
+    instead of fork() + exec()
+    """
+    return shutil.which(name) or name
 
 
 class SSHClient():
+    """
+    multiplex: when True, all ssh and rsync invocations towards the same host
+    share a single connection (OpenSSH ControlMaster), which is opened
+    on first use and kept alive for a while; not supported on Windows,
+    where every invocation opens its own connection
+    name: prefixes all output lines, to tell apart concurrent hosts (default: host)
+    """
 
     def __init__(self, host, ssh_user='', ssh_options='', rsync_options='', verbose=False, dry_run=False, timeout=0, colorize=True,
-        logger=None, render_context={}):
+        logger=None, render_context={}, multiplex=False, name=''):
         self.host = host
+        self.name = name or host
         self.ssh_user = ssh_user
         self.ssh_options = ssh_options
         self.rsync_options = rsync_options
@@ -22,80 +62,86 @@ class SSHClient():
         self.colorize = colorize
         self.logger = logger
         self.render_context = render_context
+        self.control_path = ''
+        if multiplex and os.name != 'nt' and 'ControlPath' not in ssh_options:
+            # "%C" is expanded by ssh to a hash of local host, remote host, port and user
+            self.control_path = os.path.join(control_sockets_folder(), '%C')
+        self._master_cleanup_registered = False
+
+    def exec_command(self, command, become=False, become_user='', wrap_bash=True, capture_output=True):
+        """
+        capture_output: collect and return the command output;
+        when False, the output is only logged, and an empty string is returned
+        """
+
+        inner_command = self._build_inner_command(command, become, become_user, wrap_bash)
+
+        # We finally build the whole SSH statement;
+        # since no local shell is involved, ssh receives the remote command
+        # as a single argument, and no further escaping is required
+
+        remote_command = ['ssh'] + self._ssh_options()
+        if self.timeout:
+            remote_command += ['-o', 'ConnectTimeout=%d' % self.timeout]
+        remote_command += [self._remote_address(), inner_command]
+
+        result = self._run_remote_command(remote_command, capture_output)
+        return result
 
-    def exec_command(self, command, become=False, become_user='', wrap_bash=True):
+    def _build_inner_command(self, command, become, become_user, wrap_bash):
+        """
+        Build the command line to be executed on the remote host
+        """
 
         # Given command may be either a string, or a list of strings
         # in the latter case, we join string with '&&' bash operator
-        if type(command) == list:
-            inner_command = ' && '.join(command)
-        else:
-            inner_command = command
-
-        if wrap_bash:
-            inner_command = "/bin/bash -c \"cd && %s\"" % inner_command
+        joined = ' && '.join(command) if isinstance(command, list) else command
+        inner_command = f'/bin/bash -c "cd && {joined}"' if wrap_bash else joined
 
         # sudo when required
         if become:
-            prefix = "sudo -H --non-interactive "
+            parts = ['sudo', '-H', '--non-interactive']
             if become_user:
-                prefix += "-u %s " % become_user
-            inner_command = prefix + inner_command
-
-        #
-        # "Escaping single quotes in shell for postgresql"
-        # https://stackoverflow.com/questions/24095203/escaping-single-quotes-in-shell-for-postgresql
-        #
-        # > What I usually do is use double quotes (") for postgres -c's argument
-        #   and escaped double quotes (\") for psql -c's argument.
-        #   That way, I can use single quotes (') inside the SQL string with no problem:
-        #
-        #         su postgres -c "psql -c \"SELECT 'hi'  \" "
-        #
-
-        inner_command = inner_command.replace('"', '\\"')
-        #self._print_message(inner_command)
-
-        # We finally build the whole SSH statement
-
-        remote_command = 'ssh '
-        if self.ssh_options:
-            remote_command += self.ssh_options + ' '
-        if self.timeout:
-            remote_command += '-o ConnectTimeout=%d ' % self.timeout
-        # if self.ssh_user:
-        #     remote_command += self.ssh_user + "@"
-        # remote_command += self.host
-        remote_command += self._remote_address()
-
-        remote_command += " \"%s\"" % inner_command
-        #self._print_message(remote_command)
+                parts += ['-u', become_user]
+            parts.append(inner_command)
+            inner_command = ' '.join(parts)
 
-        result = self._run_remote_command(remote_command)
-        return result
+        return inner_command
 
-    def exec_rsync(self, source, destination, become=False, become_user='', ignore_existing=False, mode='', owner='', group='', as_template=False):
+    def exec_rsync(self, source, destination, become=False, become_user='', ignore_existing=False, mode='', owner='', group='', as_template=False,
+        capture_output=True, whole_file=True, compress=True):
         """
         as_template: render source by render_string() before submitting
+        capture_output: collect and return the rsync output
+        whole_file: skip rsync's delta-transfer algorithm, and just send the whole file;
+            usually faster, unless the link is slow and the destination
+            already contains a similar file
+        compress: compress data during the transfer
         """
-        remote_command = 'rsync -avz --progress '
+        remote_command = ['rsync', '-avz' if compress else '-av', '--progress']
+        if whole_file:
+            remote_command += ['--whole-file']
         if self.timeout:
-            remote_command +=  '--timeout=%d ' % self.timeout
+            remote_command += ['--timeout=%d' % self.timeout]
         if ignore_existing:
-            remote_command += '--ignore-existing '
+            remote_command += ['--ignore-existing']
 
         if mode:
-            remote_command += f'--chmod="{mode}" '
+            remote_command += [f'--chmod={mode}']
 
         chown = f'{owner}:{group}'
         if len(chown) > 1:
-            remote_command += f'--chown="{chown}" '
+            remote_command += [f'--chown={chown}']
 
         if become:
-            remote_command += '--rsync-path="sudo -u %s rsync" ' % (become_user or "root")
+            remote_command += ['--rsync-path=sudo -u %s rsync' % (become_user or "root")]
+
+        ssh_options = self._ssh_options()
+        if ssh_options:
+            remote_command += ['-e', shlex.join(['ssh'] + ssh_options)]
 
         if self.rsync_options:
-            remote_command += self.rsync_options + ' '
+            remote_command += shlex.split(self.rsync_options)
 
         if as_template:
 
@@ -108,68 +154,93 @@ class SSHClient():
                     with open(source2, "wt") as f2:
                         f2.write(rendered_text)
 
-                remote_command += f'"{source2}" "{self._remote_address()}:{destination}" '
-                result = self._run_remote_command(remote_command)
+                remote_command += [source2, f'{self._remote_address()}:{destination}']
+                result = self._run_remote_command(remote_command, capture_output)
         else:
 
-            remote_command += f'"{source}" "{self._remote_address()}:{destination}" '
-            result = self._run_remote_command(remote_command)
+            remote_command += [source, f'{self._remote_address()}:{destination}']
+            result = self._run_remote_command(remote_command, capture_output)
 
         return result
 
-    def _run_remote_command(self, remote_command):
+    def close_master_connection(self):
+        """
+        Ask the multiplexing master connection, if any, to exit
+        """
+        if not self.control_path:
+            return
+        remote_command = ['ssh'] + self._ssh_options() + ['-O', 'exit', self._remote_address()]
+        subprocess.call(
+            remote_command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
 
-        remote_command = self.render_string(remote_command)
+    def _ssh_options(self):
+        options = shlex.split(self.ssh_options)
+        if self.control_path:
+            options += [
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=' + self.control_path,
+                '-o', 'ControlPersist=60s',
+            ]
+        return options
+
+    def _run_remote_command(self, remote_command, capture_output=True):
+        """
+        remote_command: the argv list to be executed (no shell is involved)
+        capture_output: collect and return the output
+
+        Output is logged line by line as soon as it is produced
+        """
 
-        self._log(logging.DEBUG, remote_command)
+        remote_command = [self.render_string(arg) for arg in remote_command]
+        self._log(logging.DEBUG, shlex.join(remote_command))
         result = ''
         if not self.dry_run:
 
+            # Close the master connection, if any, on exit
+            if self.control_path and not self._master_cleanup_registered:
+                atexit.register(self.close_master_connection)
+                self._master_cleanup_registered = True
+
             # rc = os.system(remote_command)
             # if rc != 0:
             #     raise Exception("Previous command failed with error code: %d" % rc)
 
             try:
-                result = subprocess.check_output(
+                # CPython spawns the child via posix_spawn() only when given the full path
+                # of the executable, and close_fds=False; the latter is safe, since
+                # file descriptors created by Python are not inheritable anyway
+                lines = []
+                with subprocess.Popen(
                     remote_command,
-                    shell=True,
+                    executable=find_executable(remote_command[0]),
+                    close_fds=False,
+                    stdout=subprocess.PIPE,
                     stderr=subprocess.STDOUT,
                     encoding='utf-8',
-                )
-                #self._print_message(result)
+                    bufsize=1,
+                ) as process:
+                    for line in process.stdout:
+                        self._log(logging.DEBUG, line.rstrip('\n'))
+                        if capture_output:
+                            lines.append(line)
+                result = ''.join(lines)
+                if process.returncode:
+                    raise subprocess.CalledProcessError(process.returncode, remote_command, output=result)
             except subprocess.CalledProcessError as e:
                 if self.verbose:
-                    print('ERROR ....................: ' + e.output)
+                    print_message('%s | ERROR ....................: exit status %d' % (self.name, e.returncode), False)
                 raise
 
-            # result = subprocess.check_output(
-            #     remote_command,
-            #     shell=True,
-            #     stderr=subprocess.STDOUT,
-            #     encoding='utf-8',
-            # )
-
-        self._log(logging.DEBUG, result)
         # if action.register:
         #     self.results[action.register] = result
         return result
 
     def render_string(self, string):
-
-        # Jinja nested rendering on variable content
-        # https://stackoverflow.com/questions/8862731/jinja-nested-rendering-on-variable-content#34002296
-        def recursive_render(tpl, values):
-             prev = tpl
-             while True:
-                 curr = jinja2.Template(prev, undefined=jinja2.StrictUndefined).render(**values)
-                 if curr != prev:
-                     prev = curr
-                 else:
-                     return curr
-
-        if not self.render_context:
+        if not self.render_context or not has_template_markers(string):
             return string
-
         return recursive_render(string, self.render_context)
 
     def _remote_address(self):
@@ -180,18 +251,14 @@ class SSHClient():
         return text
 
     def _log(self, level, message):
+        message = '%s | %s' % (self.name, message)
         self._print_message(message)
         if self.logger:
             self.logger.log(level, message)
 
     def _print_message(self, line):
         if self.verbose:
-            if self.colorize:
-                from rich.console import Console
-                console = Console()
-                console.print(line, style="yellow")
-            else:
-                print(line)
+            print_message(line, self.colorize)
 
 
 if __name__ == '__main__':
@@ -216,6 +283,8 @@ if __name__ == '__main__':
     parser.add_argument("--destination", help="rsync destination")
     parser.add_argument("--ignore-existing", action="store_true", help="rsync to skip existing files")
     parser.add_argument("--rsync-options", type=str, default="")
+    parser.add_argument("--delta", action="store_true", help="rsync to use the delta-transfer algorithm")
+    parser.add_argument("--no-compress", action="store_true", help="rsync to skip compression")
     parser.add_argument(
         "--traceback", action="store_true", help="Print errors traceback"
     )
@@ -249,7 +318,8 @@ if __name__ == '__main__':
                 print("destination is required")
             if args.source and args.destination:
                 client.exec_rsync(source=args.source, destination=args.destination,
-                    become=args.become, become_user=args.become_user, ignore_existing=args.ignore_existing)
+                    become=args.become, become_user=args.become_user, ignore_existing=args.ignore_existing,
+                    whole_file=not args.delta, compress=not args.no_compress)
 
 
     except Exception as e:
@@ -1,6 +1,28 @@
 #!/usr/bin/env python3
+import functools
+import hashlib
 import json
 import logging
+import os
+import threading
+import jinja2
+from collections.abc import Mapping
+from pathlib import Path
+
+try:
+    import msgspec
+except ModuleNotFoundError:
+    msgspec = None
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+try:
+    import ijson
+except ModuleNotFoundError:
+    ijson = None
 
 # import subprocess
 # import argparse
@@ -15,6 +37,82 @@ import logging
 logger = logging.getLogger("deploy")
 
 
+class DeployConfigError(Exception):
+    """
+    The configuration (vars, hosts, actions or templates) could not be loaded, or is invalid
+    """
+    pass
+
+
+# Template sources, keyed by a stable hash, while being loaded; see compile_template()
+_template_sources = {}
+_template_sources_lock = threading.Lock()
+
+# Sources whose compiled bytecode may be persisted on disk; see persist_template()
+_persistent_sources = set()
+
+
+def _build_jinja_env():
+    """
+    Build the single Jinja environment shared by all renderings
+    """
+    return jinja2.Environment(
+        loader=jinja2.FunctionLoader(_template_sources.get),
+        undefined=jinja2.StrictUndefined,
+    )
+
+
+_JINJA_ENV = _build_jinja_env()
+
+# Max number of nested rendering passes applied by recursive_render()
+_MAX_RENDER_PASSES = 10
+
+# Parsed JSON files, keyed by (absolute path, modification time, size)
+_json_cache = {}
+
+# Shared rich Console; see get_console()
+_console = None
+
+# Serializes printing and logging from concurrent hosts; see print_message() and share_print_lock()
+_print_lock = threading.RLock()
+
+# Filtered JSON files larger than this (in bytes) are parsed incrementally, when ijson is available
+JSON_STREAMING_THRESHOLD = 256 * 1024
+
+
+def get_console():
+    """
+    Return the shared rich Console, building it on first use;
+    Console() performs terminal detection, which we don't want to repeat
+    for every printed line
+    """
+    global _console
+    if _console is None:
+        from rich.console import Console
+        _console = Console()
+    return _console
+
+
+def print_message(line, colorize):
+    """
+    Print a line on the console; safe to be called from concurrent threads,
+    as lines are never interleaved
+    """
+    with _print_lock:
+        if colorize:
+            get_console().print(line, style="yellow")
+        else:
+            print(line, flush=True)
+
+
+def share_print_lock(handler):
+    """
+    Make the given logging handler use the same lock as print_message(),
+    so that log records and printed lines never interleave
+    """
+    handler.lock = _print_lock
+
+
 def merge_dicts(d1, d2):
     """
     Merge two dictionaries;
@@ -27,15 +125,167 @@ def merge_dicts(d1, d2):
     return {**d1, **d2}
 
 
-def load_json_file(filename, fail_silently=False):
+def _json_default(obj):
+    # Serialize any mapping (i.e. UserDict, ChainMap) as a plain dict
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+
+def dump_json(data):
+    """
+    Serialize data as JSON text indented by 4 spaces;
+    uses msgspec when available, falling back to the json module
+    (orjson is not an option here, as it only supports an indent of 2)
+    """
+    if msgspec:
+        return msgspec.json.format(msgspec.json.encode(data, enc_hook=_json_default), indent=4).decode()
+    return json.dumps(data, indent=4, ensure_ascii=False, default=_json_default)
+
+
+def filter_json_entries(data, keep):
+    """
+    Select the top-level entries (list items, or values of the root object)
+    for which keep(entry) is true
+    """
+    if isinstance(data, dict):
+        return {k: v for k, v in data.items() if keep(v)}
+    return [v for v in data if keep(v)]
+
+
+def stream_json_file(filename, keep):
+    """
+    Same as filter_json_entries(), but parsing the file incrementally with ijson,
+    so that rejected entries are discarded as soon as they have been read
+    """
+    with open(filename, "rb") as f:
+        # Peek the first significant char to detect the type of the root element
+        c = f.read(1)
+        while c.isspace():
+            c = f.read(1)
+        f.seek(0)
+        if c == b'{':
+            return {k: v for k, v in ijson.kvitems(f, '', use_float=True) if keep(v)}
+        return [v for v in ijson.items(f, 'item', use_float=True) if keep(v)]
+
+
+def load_json_file(filename, fail_silently=False, keep=None):
+    """
+    Load the given JSON file;
+    if "keep" is given, select only the top-level entries for which keep(entry) is true
+    """
     if not filename.lower().endswith('.json'):
         filename += '.json'
     try:
-        with open(filename, "rt") as f:
-            data = json.load(f)
+        st = os.stat(filename)
+        if keep and ijson and st.st_size > JSON_STREAMING_THRESHOLD:
+            return stream_json_file(filename, keep)
+
+        # Parse each file only once, unless it has been modified in the meantime;
+        # callers must not mutate the returned data, which is shared
+        # (the size is checked too, as mtime resolution may be coarse on some filesystems)
+        key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+        data = _json_cache.get(key)
+        if data is None:
+            # Parse raw bytes, skipping a separate text decoding step
+            raw = Path(filename).read_bytes()
+            data = orjson.loads(raw) if orjson else json.loads(raw)
+            _json_cache[key] = data
+        if keep:
+            data = filter_json_entries(data, keep)
     except Exception as e:
-        logger.error('JSONDecodeError in file "%s": %s' % (filename, str(e)))
         if not fail_silently:
-            exit()
+            raise DeployConfigError('Error loading file "%s": %s' % (filename, str(e))) from e
+        logger.error('JSONDecodeError in file "%s": %s' % (filename, str(e)))
         data = {}
     return data
+
+
+def has_template_markers(string):
+    """
+    Check whether the given string contains any Jinja markup at all;
+    plain literals (most shell commands) are already a rendering fixpoint
+    """
+    return '{{' in string or '{%' in string or '{#' in string
+
+
+def enable_bytecode_cache(directory=None):
+    """
+    Persist on disk the compiled bytecode of the templates registered
+    with persist_template(), so that re-running the same deployment
+    skips their compilation; the cache folder is private to the current user
+    """
+    if directory is None:
+        directory = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+            'minimalistic-deploy',
+            'jinja',
+        )
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    except OSError as e:
+        logger.warning('Jinja bytecode cache not available: %s' % str(e))
+        return
+    _JINJA_ENV.bytecode_cache = jinja2.FileSystemBytecodeCache(directory=directory, pattern='%s.cache')
+
+
+@functools.lru_cache(maxsize=2048)
+def compile_template(source):
+    """
+    Compile the given source string into a Jinja template;
+    results are cached, since the same strings (commands, items, "when" expressions)
+    are rendered over and over for every host
+    """
+    if _JINJA_ENV.bytecode_cache is None or source not in _persistent_sources:
+        return _JINJA_ENV.from_string(source)
+
+    # The bytecode cache is only consulted for templates obtained from the loader,
+    # so we serve the source under a name derived from its content
+    name = hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
+    with _template_sources_lock:
+        _template_sources[name] = source
+        try:
+            return _JINJA_ENV.get_template(name)
+        finally:
+            del _template_sources[name]
+
+
+def persist_template(source):
+    """
+    Compile the given source, which comes verbatim from the configuration files,
+    allowing its bytecode to be persisted when the bytecode cache is enabled;
+    intermediate renderings (which may contain the values of vars) never are
+    """
+    _persistent_sources.add(source)
+    return compile_template(source)
+
+
+def recursive_render(tpl, values):
+    """
+    Render the given template string until a fixpoint is reached,
+    or no markup is left; the number of passes is bounded, to protect
+    against templates which keep producing new markup, and DeployConfigError
+    is raised when the limit is hit (partially rendered text is never returned)
+
+    Jinja nested rendering on variable content
+    https://stackoverflow.com/questions/8862731/jinja-nested-rendering-on-variable-content#34002296
+    """
+    prev = tpl
+    for n in range(_MAX_RENDER_PASSES):
+        if not has_template_markers(prev):
+            break
+        if n == 2:
+            # Deeply nested templates are legit, but worth noticing
+            logger.debug('Template requires more than two rendering passes: "%s"' % tpl)
+        # Note: Jinja still copies values into a new dict at each render;
+        # passing the mapping positionally only spares the extra **kwargs dict
+        curr = compile_template(prev).render(values)
+        if curr == prev:
+            break
+        prev = curr
+    else:
+        if has_template_markers(prev):
+            raise DeployConfigError(
+                'Template "%s" still contains markup after %d rendering passes' % (tpl, _MAX_RENDER_PASSES)
+            )
+    return prev